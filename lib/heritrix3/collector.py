@@ -30,6 +30,7 @@ CRAWL_JOBS_FILE = os.environ.get("CRAWL_JOBS_FILE", '../../dash/crawl-jobs-local
 class Heritrix3Collector(object):
 
     def __init__(self):
+        # The worker pool is created once and re-used for every request/scrape:
         self.pool = Pool(20)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -105,8 +106,6 @@ class Heritrix3Collector(object):
             argsv.append((job['id'], job['job_name'], server_url, server_user, server_pass, action))
         # Wait for all...
         result_list = self.pool.map(do_h3_action, argsv)
-        self.pool.terminate()
-        self.pool.join()
         # Collect:
         results = {}
         for job, status in result_list:
@@ -172,8 +171,6 @@ class Heritrix3Collector(object):
             argsv.append((job['id'], job['job_name'], server_url, server_user, server_pass))
         # Wait for all...
         result_list = self.pool.map(get_h3_status, argsv)
-        self.pool.terminate()
-        self.pool.join()
         # Collect:
         results = {}
         for job, status in result_list:
@@ -186,7 +183,7 @@ class Heritrix3Collector(object):
                 job['state']['status'] = "LOOKUP FAILED"
 
         # Also get the KafkaReport:
-        kafka_results = Heritrix3Collector().do('kafka-report')
+        kafka_results = self.do('kafka-report')
         for h in services:
             for k in kafka_results['services']:
                 if h['url'] == k['url']:
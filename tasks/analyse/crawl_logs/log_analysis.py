@@ -6,7 +6,7 @@ import luigi.contrib.hdfs
 import luigi.contrib.hadoop
 from luigi.contrib.hdfs.format import Plain, PlainDir
 
-from tasks.analyse.crawl_logs.log_analysis_hadoop import AnalyseLogFile, SummariseLogFiles
+from tasks.analyse.crawl_logs.log_analysis_hadoop import AnalyseLogFile, SummariseLogFiles, watched_surts_for_targets
 from tasks.analyse.crawl_logs.documents import ExtractDocumentAndPost
 from tasks.crawl.w3act import CrawlFeed
 from tasks.common import state_file, logger
@@ -99,20 +99,42 @@ class SyncToHdfs(luigi.Task):
         status = client.client.status(self.target_path)
 
 
+class GenerateWatchedSurts(luigi.Task):
+    """
+    Pre-processes a crawl feed into a plain list of the SURT prefixes of all the Watched seeds, one per line.
+
+    This means the Hadoop mappers only have to read in the prefixes, rather than each mapper loading and processing
+    the whole crawl feed.
+    """
+    targets_path = luigi.Parameter()
+
+    def output(self):
+        return luigi.LocalTarget(path="%s.watched-surts.txt" % os.path.splitext(self.targets_path)[0])
+
+    def run(self):
+        with open(str(self.targets_path)) as f:
+            targets = json.load(f)
+        with self.output().open('w') as f:
+            for surt in watched_surts_for_targets(targets):
+                f.write("%s\n" % surt)
+
+
 class AnalyseAndProcessDocuments(luigi.Task):
     task_namespace = 'analyse'
     job = luigi.Parameter()
     launch_id = luigi.Parameter()
     log_paths = luigi.ListParameter()
-    targets_path = luigi.Parameter()
+    targets_path = luigi.Parameter(default=None)
     from_hdfs = luigi.BoolParameter(default=False)
+    watched_surts_path = luigi.Parameter(default=None)
 
     # Size of bunches of jobs to yield
     bunch_size = 10000
 
     def requires(self):
         # Analyse the log file on HDFS, using only one reducer:
-        return AnalyseLogFile(self.job, self.launch_id, self.log_paths, self.targets_path, self.from_hdfs, 1)
+        return AnalyseLogFile(self.job, self.launch_id, self.log_paths, self.targets_path, self.from_hdfs, 1,
+                              watched_surts_path=self.watched_surts_path)
 
     def output(self):
         return TaskTarget('documents', 'posted-{}-{}-{}.jsonl'.format(self.job, self.launch_id, len(self.log_paths)))
@@ -186,8 +208,11 @@ class GenerateCrawlLogReports(luigi.Task):
         feed = yield CrawlFeed('all')
         logs_count = len(self.input())
 
-        # Cache targets in an appropriately unique filename (as unique as this task):
-        hdfs_targets = yield SyncToHdfs(feed.path, '/tmp/cache/crawl-feed-%s-%s-%i.json' % (self.job, self.launch_id, logs_count), overwrite=True)
+        # Reduce the feed to just the watched SURTs, so the mappers don't all have to process the whole feed:
+        surts = yield GenerateWatchedSurts(feed.path)
+
+        # Cache the SURTs in an appropriately unique filename (as unique as this task):
+        hdfs_surts = yield SyncToHdfs(surts.path, '/tmp/cache/crawl-feed-%s-%s-%i.watched-surts.txt' % (self.job, self.launch_id, logs_count), overwrite=True)
 
         # Turn the logs into a list:
         log_paths = []
@@ -195,15 +220,15 @@ class GenerateCrawlLogReports(luigi.Task):
             log_paths.append(log_file.path)
 
         # Yield a task for processing all the current logs (Hadoop job):
-        log_stats = yield AnalyseLogFile(self.job, self.launch_id, log_paths, hdfs_targets.path, True)
+        log_stats = yield AnalyseLogFile(self.job, self.launch_id, log_paths, from_hdfs=True, watched_surts_path=hdfs_surts.path)
 
         # If we are looking at documents, extract them:
         if self.extract_documents:
-            yield AnalyseAndProcessDocuments(self.job, self.launch_id, log_paths, hdfs_targets.path, True)
+            yield AnalyseAndProcessDocuments(self.job, self.launch_id, log_paths, from_hdfs=True, watched_surts_path=hdfs_surts.path)
 
         # And clean out the file from temp:
-        logger.warning("Removing temporary targets cache: %s" % hdfs_targets.path)
-        hdfs_targets.remove()
+        logger.warning("Removing temporary watched SURTs cache: %s" % hdfs_surts.path)
+        hdfs_surts.remove()
 
 
 class DomainCrawlSummarise(luigi.WrapperTask):
@@ -1,15 +1,21 @@
 import re
 import os
-import json
 import logging
 import datetime
-from urllib.parse import urlparse
+from collections import Counter
+from urllib.parse import urlsplit
 import luigi
 import luigi.contrib.hdfs
 import luigi.contrib.hadoop
 from luigi.contrib.hdfs.format import Plain, PlainDir
 from lib.surt import url_to_surt
 
+# Use the faster C implementation of JSON (de)serialisation where it's installed:
+try:
+    import ujson as json
+except ImportError:
+    import json
+
 import lib, dateutil, six # Imported so extra_modules MR-bundle can access them
 #import surt, tldextract, idna, requests, urllib3, certifi, chardet, requests_file, six # Unfortunately the surt module has a LOT of dependencies.
 
@@ -17,10 +23,46 @@ import lib, dateutil, six # Imported so extra_modules MR-bundle can access them
 logger = logging.getLogger(__name__)
 
 
+def _is_ip(annot):
+    """
+    Is this annotation a dotted-quad IP address? (Plain string checks are much quicker than a regex for this).
+    """
+    return len(annot) <= 15 and annot.count('.') == 3 and annot.replace('.', '').isdigit()
+
+
+def _is_tries(annot):
+    """
+    Is this annotation a retry count, like '3t'?
+    """
+    return len(annot) > 1 and annot[-1] == 't' and annot[:-1].isdigit()
+
+
+# Separators used for encoding CrawlLogLine stats (see CrawlLogLine.stats_encoded):
+_STATS_SEP = '\x01'
+_STATS_KV_SEP = '\x02'
+
+
+def decode_stats(encoded):
+    """
+    Decodes stats encoded by CrawlLogLine.stats_encoded().
+
+    :param encoded:
+    :return: generator of (key, value) pairs, where properties with no value have an empty string value.
+    """
+    for prop in encoded.split(_STATS_SEP):
+        key, _, value = prop.partition(_STATS_KV_SEP)
+        yield key, value
+
+
 class CrawlLogLine(object):
     """
     Parsers Heritrix3 format log files, including annotations and any additional extra JSON at the end of the line.
     """
+    # One of these is created for every log line, so avoid having a per-instance __dict__:
+    __slots__ = ('timestamp', 'status_code', 'content_length', 'url', 'hop_path', 'via', 'mime', 'thread',
+                 'start_time_plus_duration', 'hash', 'source', 'annotation_string', 'annotations', 'extra_json',
+                 '_parsed_url')
+
     def __init__(self, line):
         """
         Parse from a standard log-line.
@@ -28,20 +70,19 @@ class CrawlLogLine(object):
         """
         (self.timestamp, self.status_code, self.content_length, self.url, self.hop_path, self.via,
             self.mime, self.thread, self.start_time_plus_duration, self.hash, self.source,
-            self.annotation_string) = re.split(" +", line.strip(), maxsplit=11)
+            self.annotation_string) = line.strip().split(None, 11)
         # Account for any JSON 'extra info' ending, strip or split:
-        if self.annotation_string.endswith(' {}'):
-            self.annotation_string = self.annotation_string[:-3]
-        elif ' {"' in self.annotation_string and self.annotation_string.endswith('}'):
-            self.annotation_string, self.extra_json = re.split(re.escape(' {"'), self.annotation_string, maxsplit=1)
-            self.extra_json = '{"%s' % self.extra_json
+        head, sep, tail = self.annotation_string.partition(' {')
+        if sep:
+            if tail == '}':
+                self.annotation_string = head
+            elif tail.startswith('"') and tail.endswith('}'):
+                self.annotation_string = head
+                self.extra_json = '{%s' % tail
         # And split out the annotations:
         self.annotations = self.annotation_string.split(',')
-
-        # Some regexes:
-        self.re_ip = re.compile('^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$')
-        self.re_tries = re.compile('^\d+t$')
-        self.re_dol = re.compile('^dol:\d+') # Discarded out-links - make a total?
+        # The URL is only parsed if needed, and then only once:
+        self._parsed_url = None
 
     def stats(self):
         """
@@ -59,20 +100,42 @@ class CrawlLogLine(object):
         }
         # Add in annotations:
         for annot in self.annotations:
-            # Set a prefix based on what it is:
-            prefix = ''
-            if self.re_tries.match(annot):
-                prefix = 'tries:'
-            elif self.re_ip.match(annot):
-                prefix = "ip:"
+            # Only emit lines with annotations:
+            if annot == "-":
+                continue
             # Skip high-cardinality annotations:
             if annot.startswith('launchTimestamp:'):
                 continue
-            # Only emit lines with annotations:
-            if annot != "-":
-                stats["%s%s" % (prefix, annot)] = ""
+            # Add a prefix based on what it is (both kinds start with a digit), otherwise use it as-is:
+            if annot[:1].isdigit():
+                if _is_tries(annot):
+                    annot = 'tries:' + annot
+                elif _is_ip(annot):
+                    annot = 'ip:' + annot
+            stats[annot] = ""
         return stats
 
+    def stats_encoded(self):
+        """
+        Encodes the stats() in a compact form for passing from the mapper to the reducer, which is much quicker to
+        generate and parse than JSON. Properties are separated by \\x01, and a key from any non-empty value by \\x02.
+        These control characters do not turn up in crawl log fields. See decode_stats().
+
+        :return:
+        """
+        return _STATS_SEP.join(
+            key + _STATS_KV_SEP + value if value else key for key, value in self.stats().items())
+
+    def parsed_url(self):
+        """
+        Parses the URL, caching the result so the host and path lookups can share it.
+
+        :return:
+        """
+        if self._parsed_url is None:
+            self._parsed_url = urlsplit(self.url)
+        return self._parsed_url
+
     def host(self):
         """
         Extracts the host, depending on the protocol.
@@ -82,7 +145,7 @@ class CrawlLogLine(object):
         if self.url.startswith("dns:"):
             return self.url[4:]
         else:
-            return urlparse(self.url).hostname
+            return self.parsed_url().hostname
 
     def hour(self):
         """
@@ -107,47 +170,72 @@ class CrawlLogLine(object):
         return datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
 
 
+def watched_surts_for_targets(targets):
+    """
+    Finds the SURT prefixes of the seeds of all Watched targets in a crawl feed.
+
+    :param targets: the crawl feed, as a list of target dicts.
+    :return: a tuple of unique SURT prefixes, longest first.
+    """
+    watched = set()
+    for t in targets:
+        # Find any watched seeds:
+        if t['watched']:
+            watched.update(t['seeds'])
+    # Convert to SURT form, dropping any duplicates (different seeds can have the same SURT), longest first.
+    # Returned as a tuple so it can be passed straight to str.startswith:
+    return tuple(sorted({url_to_surt(url) for url in watched}, key=len, reverse=True))
+
+
 class CrawlLogExtractors(object):
 
-    def __init__(self, job, launch, from_hdfs, targets_path=None):
+    # Size of the chunks to read when scanning whole log files:
+    read_chunk_size = 4*1024*1024
+
+    def __init__(self, job, launch, from_hdfs, targets_path=None, watched_surts_path=None):
         self.job = job
         self.launch_id = launch
-        # Setup targets if provided:
-        if targets_path:
-            if from_hdfs:
-                hdfs_client = luigi.contrib.hdfs.HdfsClientApache1()
-                logger.warning("Loading targets using client: %s" % hdfs_client)
-                logger.warning("Loading targets from HDFS: %s" % targets_path)
-                targets = luigi.contrib.hdfs.HdfsTarget(path=targets_path, format=Plain, fs=hdfs_client)
-            else:
-                logger.warning("Loading targets from local FS: %s" % targets_path)
-                targets = luigi.LocalTarget(path=targets_path)
-            # Find the unique watched seeds list:
-            logger.warning("Loading: %s" % targets)
-            logger.warning("Loading path: %s" % targets.path)
-            targets = json.load(targets.open())
-        else:
-            targets = []
-        # Assemble the Watched SURTs:
         target_map = {}
-        watched = set()
-        for t in targets:
-            # Build-up reverse mapping
-            for seed in t['seeds']:
-                target_map[seed] = t['id']
-                # And not any watched seeds:
-                if t['watched']:
-                    watched.add(seed)
-
-        # Convert to SURT form:
-        watched_surts = []
-        for url in watched:
-            watched_surts.append(url_to_surt(url))
-        logger.warning("WATCHED SURTS %s" % watched_surts)
+        if watched_surts_path:
+            # Use the pre-computed list of watched SURTs, one per line (see GenerateWatchedSurts), so each mapper
+            # does not have to load and process the whole crawl feed:
+            with self.open_path(watched_surts_path, from_hdfs).open() as f:
+                data = f.read()
+            if isinstance(data, bytes):
+                data = data.decode('utf-8')
+            watched_surts = tuple(data.split())
+        else:
+            # Setup targets if provided:
+            if targets_path:
+                targets = self.open_path(targets_path, from_hdfs)
+                # Find the unique watched seeds list:
+                logger.warning("Loading: %s" % targets)
+                logger.warning("Loading path: %s" % targets.path)
+                targets = json.load(targets.open())
+            else:
+                targets = []
+            for t in targets:
+                # Build-up reverse mapping
+                for seed in t['seeds']:
+                    target_map[seed] = t['id']
+            # Assemble the Watched SURTs:
+            watched_surts = watched_surts_for_targets(targets)
+        logger.warning("WATCHED SURTS %s" % (watched_surts,))
 
         self.watched_surts = watched_surts
         self.target_map = target_map
 
+    @staticmethod
+    def open_path(path, from_hdfs):
+        if from_hdfs:
+            hdfs_client = luigi.contrib.hdfs.HdfsClientApache1()
+            logger.warning("Loading using client: %s" % hdfs_client)
+            logger.warning("Loading from HDFS: %s" % path)
+            return luigi.contrib.hdfs.HdfsTarget(path=path, format=Plain, fs=hdfs_client)
+        else:
+            logger.warning("Loading from local FS: %s" % path)
+            return luigi.LocalTarget(path=path)
+
     def analyse_log_file(self, log_file):
         """
         To run a series of analyses on a log file and emit results suitable for reduction.
@@ -155,9 +243,20 @@ class CrawlLogExtractors(object):
         :return:
         """
         with log_file.open() as f:
-            for line in f:
-                log = CrawlLogLine(line)
-                yield self.extract_documents(log)
+            # Read in large chunks and split them into lines, carrying any partial last line over to the next chunk:
+            carry = ''
+            while True:
+                buf = f.read(self.read_chunk_size)
+                if not buf:
+                    break
+                lines = (carry + buf).split('\n')
+                carry = lines.pop()
+                for line in lines:
+                    log = CrawlLogLine(line)
+                    yield self.extract_documents(log)
+            # Any final line without a trailing newline:
+            if carry:
+                yield self.extract_documents(CrawlLogLine(carry))
 
     def target_id(self, log):
         return self.target_map.get(log.source, None)
@@ -169,31 +268,33 @@ class CrawlLogExtractors(object):
         :param log:
         :return:
         """
-        # Skip non-downloads:
-        if log.status_code == '-' or log.status_code == '' or int(int(log.status_code) / 100) != 2:
+        # Skip non-downloads (2xx only, checked without parsing the status code):
+        if log.status_code[:1] != '2':
             return
-        # Check the URL and Content-Type:
-        if "application/pdf" in log.mime:
-            for prefix in self.watched_surts:
-                document_surt = url_to_surt(log.url)
-                landing_page_surt = url_to_surt(log.via)
-                #logger.warning("Looking for prefix '%s' in '%s' and '%s'" % (prefix,document_surt, landing_page_surt))
-                # Are both URIs under the same watched SURT:
-                if document_surt.startswith(prefix) or landing_page_surt.startswith(prefix):
-                    # Proceed to extract metadata and pass on to W3ACT:
-                    doc = {
-                        'wayback_timestamp': log.start_time_plus_duration[:14],
-                        'landing_page_url': log.via,
-                        'document_url': log.url,
-                        'filename': os.path.basename(urlparse(log.url).path),
-                        'size': int(log.content_length),
-                        # Add some more metadata to the output so we can work out where this came from later:
-                        'job_name': self.job,
-                        'launch_id': self.launch_id,
-                        'source': log.source
-                    }
-                    #logger.info("Found document: %s" % doc)
-                    return json.dumps(doc)
+        # Check the Content-Type, and that there's anything to look for:
+        if "application/pdf" not in log.mime or not self.watched_surts:
+            return None
+        # Convert to SURTs once, rather than for every watched prefix:
+        document_surt = url_to_surt(log.url)
+        landing_page_surt = url_to_surt(log.via)
+        #logger.warning("Looking for prefixes %s in '%s' and '%s'" % (self.watched_surts, document_surt, landing_page_surt))
+        # Is either URI under a watched SURT (startswith checks the whole tuple of prefixes in one call):
+        if document_surt.startswith(self.watched_surts) or landing_page_surt.startswith(self.watched_surts):
+            # Proceed to extract metadata and pass on to W3ACT:
+            doc = {
+                'wayback_timestamp': log.start_time_plus_duration[:14],
+                'landing_page_url': log.via,
+                'document_url': log.url,
+                # (urlsplit leaves any ';params' on the last path segment, so drop them here):
+                'filename': os.path.basename(log.parsed_url().path).partition(';')[0],
+                'size': int(log.content_length),
+                # Add some more metadata to the output so we can work out where this came from later:
+                'job_name': self.job,
+                'launch_id': self.launch_id,
+                'source': log.source
+            }
+            #logger.info("Found document: %s" % doc)
+            return json.dumps(doc)
 
         return None
 
@@ -244,6 +345,12 @@ class AnalyseLogFile(luigi.contrib.hadoop.JobTask):
     # Using one output file ensures the whole output is sorted but is not suitable for very large crawls.
     n_reduce_tasks = luigi.Parameter(default=25)
 
+    # Optional pre-computed list of watched SURTs (see GenerateWatchedSurts), used instead of the targets_path feed:
+    watched_surts_path = luigi.Parameter(default=None)
+
+    # Number of mapper output records to gather up before writing them out in one go:
+    output_batch_size = 1024
+
     extractor = None
 
 
@@ -266,7 +373,8 @@ class AnalyseLogFile(luigi.contrib.hadoop.JobTask):
 
     def init_mapper(self):
         # Set up...
-        self.extractor = CrawlLogExtractors(self.job, self.launch_id, self.from_hdfs, targets_path=self.targets_path )
+        self.extractor = CrawlLogExtractors(self.job, self.launch_id, self.from_hdfs, targets_path=self.targets_path,
+                                            watched_surts_path=self.watched_surts_path)
 
     def jobconfs(self):
         """
@@ -279,17 +387,34 @@ class AnalyseLogFile(luigi.contrib.hadoop.JobTask):
         #jcs.append('mapred.min.split.size', ) mapred.max.split.size, in bytes. e.g. 256*1024*1024 = 256M
         return jcs
 
+    def internal_writer(self, outputs, stdout):
+        """
+        Writes the mapper output in batches, rather than one print() per output record.
+
+        :param outputs:
+        :param stdout:
+        :return:
+        """
+        batch = []
+        for output in outputs:
+            batch.append("\t".join(map(self.internal_serialize, output)))
+            if len(batch) >= self.output_batch_size:
+                stdout.write("%s\n" % "\n".join(batch))
+                batch = []
+        if batch:
+            stdout.write("%s\n" % "\n".join(batch))
+
     def mapper(self, line):
         # Parse:
         log = CrawlLogLine(line)
         # Extract basic data for summaries, keyed for later aggregation:
-        yield "BY_DAY_HOST_SOURCE,%s,%s,%s" % (log.day(), log.host(), log.source), json.dumps(log.stats())
+        yield "BY_DAY_HOST_SOURCE,%s,%s,%s" % (log.day(), log.host(), log.source), log.stats_encoded()
         # Scan for documents, yield sorted in crawl order:
         doc = self.extractor.extract_documents(log)
         if doc:
             yield "DOCUMENT,%s" % log.start_time_plus_duration, doc
         # Check for dead seeds:
-        if (int(int(log.status_code) / 100) != 2 and int(int(log.status_code) / 100) != 3  # 2xx/3xx are okay!
+        if (log.status_code[:1] not in ('2', '3')  # 2xx/3xx are okay!
                 and log.hop_path == "-" and log.via == "-"):  # seed
             yield "DEAD_SEED,%s,%s" % (log.url, log.start_time_plus_duration), line
 
@@ -307,24 +432,23 @@ class AnalyseLogFile(luigi.contrib.hadoop.JobTask):
                 yield key, value
         else:
             # Build up summaries of other statistics:
-            summaries = {}
+            summaries = Counter()
             for value in values:
-                properties = json.loads(value)
-                for pkey in properties:
+                for pkey, pval in decode_stats(value):
                     # For 'sum:XXX' properties, sum the values:
-                    if pkey.startswith('sum:') and properties[pkey] != '-':
-                        summaries[pkey] = summaries.get(pkey, 0) + int(properties[pkey])
+                    if pkey.startswith('sum:') and pval != '-':
+                        summaries[pkey] += int(pval)
                         continue
                     # Otherwise, default behaviour is to count occurrences of key-value pairs.
-                    if properties[pkey]:
+                    if pval:
                         # Build a composite key for keys that have non-empty values:
-                        prop = "%s:%s" % (pkey, properties[pkey])
+                        prop = "%s:%s" % (pkey, pval)
                     else:
                         prop = pkey
                     # Aggregate:
-                    summaries[prop] = summaries.get(prop, 0) + 1
+                    summaries[prop] += 1
 
-            yield key, json.dumps(summaries)
+            yield key, json.dumps(dict(summaries))
 
 
 class ExtractLogsForHost(luigi.contrib.hadoop.JobTask):
@@ -560,7 +684,7 @@ class SummariseLogFiles(luigi.contrib.hadoop.JobTask):
             }
             
 
-        parsed_url = urlparse(url)
+        parsed_url = urlsplit(url)
         host = re.sub("^(www([0-9]+)?)\.", "", parsed_url[1])                        
                                 
         yield host, json.dumps(data)